@@ -3,107 +3,393 @@
 __version__ = "1.0.0"
 
 import argparse
-import base64
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import functools
+import html
 import mimetypes
+import mmap
+import os
+import re
 import sys
 from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Union
 from urllib.parse import quote
 from urllib.parse import urljoin
-from urllib.parse import urlparse
+from urllib.parse import urlsplit
+import uuid
 
 import bs4
+# Use the SIMD-accelerated pybase64 if available, it is much faster than the
+# standard library on large images
+try:
+    import pybase64
+    from pybase64 import b64encode
+except ImportError:
+    pybase64 = None
+    # Call binascii's encoder directly, base64.b64encode only wraps it in
+    # an extra Python function call
+    import binascii
+    b64encode = functools.partial(binascii.b2a_base64, newline=False)
 # Import requests if available, dummy it if not
 try:
-    from requests import get as requests_get
+    import requests
     from requests import RequestException
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 except ImportError:
-    requests_get = None
+    requests = None
 
     class RequestException(Exception):  # NOQA   make flake8 shut up
         """Dummy exception for when Requests is not installed."""
         pass
+# Import requests-cache if available, for caching downloads between runs
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+# Load the MIME type database now, rather than on the first lookup while
+# resources are being processed
+mimetypes.init()
 
 PARSERS = ['lxml', 'html5lib', 'html.parser']
+# Number of resources downloaded simultaneously
+MAX_WORKERS = 16
+# Number of connections kept open to each host for reuse
+POOL_SIZE = 32
+# Seconds to wait for a connection to a server, and then for it to send data
+HTTP_TIMEOUT = (3.05, 27)
+# Number of times failed connections and reads are retried
+HTTP_RETRIES = 2
+# Size of the chunks downloads are streamed in. A multiple of 3, so each chunk
+# encodes to base64 without padding, and of 48, the most any of pybase64's
+# SIMD kernels encode in one step.
+CHUNK_SIZE = 57 * 1024
+# Local files at least this large are memory-mapped instead of read into memory
+MMAP_THRESHOLD = 128 * 1024
+# Buffer size for the output file, large enough that pages are written out in
+# few system calls
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+# Where downloads are cached when the HTTP cache is enabled
+HTTP_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'htmlark')
+# Seconds before cached downloads expire, unless the server says otherwise.
+# Responses without an ETag or Last-Modified date can't be revalidated, so
+# this is the longest they can be out of date.
+HTTP_CACHE_EXPIRY = 3600
+# MIME types of the most common web resources, looked up directly by file
+# extension before falling back to the mimetypes module
+FAST_MIMETYPES = {
+    'css': 'text/css',
+    'gif': 'image/gif',
+    'ico': 'image/vnd.microsoft.icon',
+    'jpeg': 'image/jpeg',
+    'jpg': 'image/jpeg',
+    'js': 'application/javascript',
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'webp': 'image/webp',
+    'woff': 'font/woff',
+    'woff2': 'font/woff2',
+}
+# MIME types of text data that aren't text/*. Data URIs of these and of text/*
+# are URL-encoded rather than base64 encoded.
+TEXT_MIMETYPES = ['', 'application/javascript', 'application/json', 'image/svg+xml']
+# Characters left unquoted in URL-encoded data URIs. These are all allowed in
+# URLs, and can't end the HTML attribute the URI is in.
+DATA_URI_SAFE = "/:@!$()*+,;="
+# Matches the scheme at the start of a URL, following the same rules as urlparse
+SCHEME_REGEX = re.compile(r'([A-Za-z][A-Za-z0-9+.-]*):')
+# Browsers (and urlparse) ignore C0 control characters and spaces around URLs
+URL_STRIP_CHARS = ''.join(chr(c) for c in range(0x21))
+
+
+def _setup_session(session):
+    """Set up a Requests session for downloading resources.
+
+    Parameters:
+        session (requests.Session): Session to set up.
+    Returns:
+        requests.Session: The same session.
+    """
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                          max_retries=Retry(total=HTTP_RETRIES, backoff_factor=0.2))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'User-Agent': f"HTMLArk/{__version__}"})
+    return session
+
+
+# A single session is shared by all downloads so connections are kept alive
+# and reused, instead of opening a new connection for every resource
+if requests is not None:
+    SESSION = _setup_session(requests.Session())
+else:
+    SESSION = None
+
+
+def enable_http_cache(cache_path: str=HTTP_CACHE_PATH, expire_after: int=HTTP_CACHE_EXPIRY):
+    """Cache downloaded resources on disk, so later runs can reuse them.
+
+    Replaces the session used for downloads with one from requests-cache,
+    storing responses in an SQLite database. Cached responses with an ETag or
+    Last-Modified date are revalidated with the server each time they are
+    used, so they are only downloaded again once they have changed. Responses
+    without either can't be checked, they are used until they expire. The
+    server's Cache-Control headers are followed if it sends any.
+
+    Parameters:
+        cache_path (str): Path of the cache database, without the .sqlite
+            extension. Default: ~/.cache/htmlark
+        expire_after (int): Seconds before cached responses expire, unless
+            the server's headers say otherwise. 0 expires them immediately,
+            so only responses that can be revalidated are reused.
+            Default: 3600
+    Raises:
+        NameError: requests-cache is not installed.
+    """
+    global SESSION
+    if requests_cache is None:
+        raise NameError("requests-cache is required to cache downloads")
+    session = requests_cache.CachedSession(cache_path, backend='sqlite',
+                                           expire_after=expire_after,
+                                           cache_control=True,
+                                           always_revalidate=True)
+    SESSION = _setup_session(session)
+
+
+# urljoin is pure Python and parses both of its arguments on every call, but
+# pages tend to repeat the same base and URLs
+_urljoin = functools.lru_cache(maxsize=4096)(urljoin)
 
 
+@functools.lru_cache(maxsize=1)
 def get_available_parsers():
-    """Return a list of parsers that can be used."""
-    available = []
-    for p in PARSERS:
-        try:
-            bs4.BeautifulSoup("", p)
-        except bs4.FeatureNotFound:
-            # Try the next parser
-            continue
+    """Return the parsers that can be used, in order of preference.
+
+    Parsers are looked up in BS4's registry of tree builders, which only
+    has those it could actually load, so nothing needs to be parsed to test
+    them. The result does not change while the program runs, so this is
+    only done on the first call.
+
+    Returns:
+        tuple: Names of the available parsers.
+    """
+    return tuple(p for p in PARSERS if bs4.builder.builder_registry.lookup(p) is not None)
+
+
+def _iter_response(response) -> Iterator[bytes]:
+    """Yield a streamed HTTP response's body in chunks, then close it."""
+    with response:
+        yield from response.iter_content(CHUNK_SIZE)
+
+
+def _iter_file(file) -> Iterator[bytes]:
+    """Yield an open file's contents, then close it.
+
+    Large files are memory-mapped and yielded in CHUNK_SIZE slices, so their
+    data can be encoded straight from the OS's page cache a chunk at a time,
+    without the file or its encoded form being copied in one piece. Each
+    slice is only valid until the next one is requested, use _join_chunks
+    to read the whole file.
+    """
+    with file:
+        if os.fstat(file.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+                    memoryview(mapped) as view:
+                for start in range(0, len(view), CHUNK_SIZE):
+                    # Each slice is released once the caller is done with it,
+                    # the map can't be closed while any are still in use
+                    with view[start:start + CHUNK_SIZE] as chunk:
+                        yield chunk
         else:
-            available.append(p)
-    return available
+            yield file.read()
+
+
+def _join_chunks(chunks: Iterable[bytes]) -> bytearray:
+    """Join chunks of data, copying each one as it is read.
+
+    Unlike bytes.join this works with the memory-mapped slices from
+    _iter_file, which are released as soon as the next one is read.
+    """
+    data = bytearray()
+    for chunk in chunks:
+        data += chunk
+    return data
 
 
-def _get_resource(resource_url: str) -> (str, bytes):
+def _guess_mimetype(path: str) -> str:
+    """Guess the MIME type of a resource from its file extension.
+
+    Parameters:
+        path (str): Path of the resource. For URLs, this must be only the
+            path, without any query or fragment (which can contain dots of
+            their own).
+    Returns:
+        str: The MIME type, or ``None`` if it is unknown.
+    """
+    extension = os.path.splitext(path)[1][1:].lower()
+    if extension in FAST_MIMETYPES:
+        return FAST_MIMETYPES[extension]
+    mimetype, _ = mimetypes.guess_type(path)
+    return mimetype
+
+
+def _get_resource(resource_url: str, stream: bool=False) -> (str, bytes):
     """Download or reads a file (online or local).
 
     Parameters:
         resource_url (str): URL or path of resource to load
+        stream (bool): If ``True``, resources are not read into memory
+            up front, the data is instead returned as an iterator over
+            chunks of the response body or file.
     Returns:
         str, bytes: Tuple containing the resource's MIME type and its data.
     Raises:
         NameError: If an HTTP request was made and ``requests`` is not available.
         ValueError: If ``resource_url``'s protocol is invalid.
     """
-    url_parsed = urlparse(resource_url)
-    if url_parsed.scheme in ['http', 'https']:
+    resource_url = resource_url.strip(URL_STRIP_CHARS)
+    # Only the scheme is needed, which is much cheaper to match than having
+    # urlparse split up the whole URL
+    scheme_match = SCHEME_REGEX.match(resource_url)
+    scheme = scheme_match.group(1).lower() if scheme_match else ''
+    if scheme in ['http', 'https']:
         # Requests might not be installed
-        if requests_get is not None:
-            request = requests_get(resource_url)
-            data = request.content
+        if SESSION is not None:
+            request = SESSION.get(resource_url, stream=stream, timeout=HTTP_TIMEOUT)
+            data = _iter_response(request) if stream else request.content
             if 'Content-Type' in request.headers:
                 mimetype = request.headers['Content-Type']
             else:
-                mimetype = mimetypes.guess_type(resource_url)
+                mimetype = _guess_mimetype(urlsplit(resource_url).path)
         else:
             raise NameError("HTTP URL found but requests not available")
-    elif url_parsed.scheme == '':
+    elif scheme == '':
         # '' is local file
-        with open(resource_url, 'rb') as f:
-            data = f.read()
-        mimetype, _ = mimetypes.guess_type(resource_url)
-    elif url_parsed.scheme == 'data':
-        raise ValueError("Resource path is a data URI", url_parsed.scheme)
+        if stream:
+            # The file is opened here so errors are raised immediately
+            data = _iter_file(open(resource_url, 'rb'))
+        else:
+            with open(resource_url, 'rb') as f:
+                data = f.read()
+        mimetype = _guess_mimetype(resource_url)
+    elif scheme == 'data':
+        raise ValueError("Resource path is a data URI", scheme)
     else:
-        raise ValueError("Not local path or HTTP/HTTPS URL", url_parsed.scheme)
+        raise ValueError("Not local path or HTTP/HTTPS URL", scheme)
 
     return mimetype, data
 
 
-def make_data_uri(mimetype: str, data: bytes) -> str:
+def make_data_uri(mimetype: str, data: Union[bytes, Iterable[bytes]]) -> str:
     """Convert data into an encoded data URI.
 
     Parameters:
         mimetype (str): String containing the MIME type of data (e.g.
             image/jpeg). If ``None``, will be treated as an empty string,
             equivalent in data URIs to ``text/plain``.
-        data (bytes): Raw data to be encoded.
+        data (bytes): Raw data to be encoded. Can also be an iterable of
+            ``bytes`` chunks, which are encoded as they are read.
     Returns:
         str: Input data encoded into a data URI.
     """
     mimetype = '' if mimetype is None else mimetype
-    if mimetype in ['', 'text/css', 'application/javascript']:
-        # Text data can simply be URL-encoded
-        encoded_data = quote(data.decode())
-    else:
-        mimetype = mimetype + ';base64'
-        encoded_data = base64.b64encode(data).decode()
-    return "data:{},{}".format(mimetype, encoded_data)
+    chunks = [data] if isinstance(data, (bytes, bytearray, memoryview)) else data
+    # Servers' Content-Type headers can have parameters, e.g. a charset
+    base_mimetype = mimetype.partition(';')[0].strip().lower()
+    if base_mimetype.startswith('text/') or base_mimetype in TEXT_MIMETYPES:
+        # Text data can simply be URL-encoded. The bytes are quoted directly,
+        # so they come out exactly the same whatever their charset.
+        text = _join_chunks(chunks)
+        quoted = quote(text, safe=DATA_URI_SAFE)
+        # Each quoted character takes three, so text with a lot of whitespace
+        # and punctuation can end up longer than base64
+        if len(quoted) <= (len(text) + 2) // 3 * 4:
+            return f"data:{mimetype},{quoted}"
+        chunks = [text]
+    # Encode straight into the URI buffer, so the (potentially very large)
+    # encoded data is not copied into an intermediate string first
+    uri = bytearray(f"data:{mimetype};base64,".encode())
+    remainder = b''
+    for chunk in chunks:
+        if remainder:
+            chunk = remainder + chunk
+        # Only whole 3-byte groups can be encoded without padding, carry any
+        # leftover bytes over to the next chunk
+        end = len(chunk) - len(chunk) % 3
+        with memoryview(chunk) as view:
+            uri += b64encode(view[:end])
+            remainder = bytes(view[end:])
+    uri += b64encode(remainder)
+    return uri.decode()
+
+
+def _load_resource(resource_url: str, inline_tag: str=None) -> (str, str, Exception):
+    """Load a resource for embedding in the page, capturing any errors.
+
+    Runs in a worker thread, so exceptions are returned instead of raised to
+    let ``convert_page`` handle them in order on the main thread.
+
+    Parameters:
+        resource_url (str): URL or path of resource to load
+        inline_tag (str): Name of the tag (``style`` or ``script``) to place
+            the resource's text in directly, if any. If the text isn't UTF-8
+            or could end that tag early, a data URI is used instead.
+    Returns:
+        str, str, Exception: Tuple containing the resource's text if it is
+        inlined, its data URI if it is not, and the exception raised while
+        loading it. Those that don't apply are ``None``.
+    """
+    try:
+        mimetype, data = _get_resource(resource_url, stream=True)
+    except (RequestException, OSError, ValueError, NameError) as e:
+        return None, None, e
+    try:
+        if inline_tag is not None:
+            data = _join_chunks(data)
+            try:
+                # A byte order mark would end up in the middle of the page
+                text = data.decode('utf-8-sig')
+            except UnicodeDecodeError:
+                # Only UTF-8 can be placed in the (UTF-8) page as it is, a data
+                # URI keeps other encodings' bytes exactly as they are
+                text = None
+            # The contents of <style> and <script> aren't escaped, any closing
+            # tag (or a comment, which changes how scripts are parsed) in them
+            # would break the page
+            if text is not None and '</' + inline_tag not in text.lower() and '<!--' not in text:
+                return text, None, None
+        # Data URIs are placed in the page as they are, without BS4 escaping
+        # them. The data never needs escaping, but the MIME type can be a
+        # server's whole Content-Type header, quoted parameters included.
+        if mimetype is not None:
+            mimetype = html.escape(mimetype)
+        return None, make_data_uri(mimetype, data), None
+    except (RequestException, OSError) as e:
+        # Streamed resources are only read here, so downloads can fail and
+        # files fail to be mapped or read partway through
+        if isinstance(e, OSError) and e.filename is None:
+            e.filename = resource_url
+        return None, None, e
 
 
 def convert_page(page_path: str, parser: str='auto',
                  callback: Callable[[str, str, str], None]=lambda *_: None,
                  ignore_errors: bool=False, ignore_images: bool=False,
-                 ignore_css: bool=False, ignore_js: bool=False) -> str:
+                 ignore_css: bool=False, ignore_js: bool=False,
+                 max_workers: int=MAX_WORKERS, resource_cache: dict=None,
+                 record_urls: bool=False) -> str:
     """Take an HTML file or URL and outputs new HTML with resources as data URIs.
 
+    Stylesheets and scripts are placed directly in ``<style>`` and
+    ``<script>`` tags instead, unless that would change how they behave
+    (alternate, disabled or titled stylesheets, ``async``/``defer``
+    scripts) or their text can't be safely placed in the page.
+
     Parameters:
         pageurl (str): URL or path of web page to convert.
     Keyword Arguments:
@@ -120,10 +406,25 @@ def convert_page(page_path: str, parser: str='auto',
             Default: ``False``
         ignore_js (bool): If ``True`` do not process ``<script>`` tags.
             Default: ``False``
-        callback (function): Called before a new resource is processed. Takes
+        max_workers (int): Maximum number of resources to download at the
+            same time. Default: 16
+        resource_cache (dict): Cache of loaded resources, keyed by resource
+            URL and how it is embedded. Resources found in it are not loaded
+            again, and newly loaded ones are added to it, so passing the same
+            dict when converting several pages only loads resources they share
+            once. Default: ``None`` - resources are only cached for a single
+            conversion.
+        record_urls (bool): If ``True`` add a comment at the end of the page
+            listing the original URL of every processed tag, one
+            ``tag:URL`` line per tag in the order they appear.
+            Default: ``False``
+        callback (function): Called as each resource is processed. Takes
             three parameters: message type ('INFO' or 'ERROR'), a string with
             the category of the callback (usually the tag related to the
             message), and the message data (usually a string to be printed).
+            It is always called from the thread that called ``convert_page``,
+            never from the threads downloading resources, so it does not need
+            to be thread-safe.
     Returns:
         str: The new webpage HTML.
     Raises:
@@ -163,9 +464,28 @@ def convert_page(page_path: str, parser: str='auto',
         >>> convert_page("badcss.html", ignore_errors=True, callback=mycallback)
         <Converted page HTML, CSS links untouched, CSS errors printed to screen>
     """
+    return ''.join(_convert_page_parts(page_path, parser, callback, ignore_errors,
+                                       ignore_images, ignore_css, ignore_js,
+                                       max_workers, resource_cache, record_urls))
+
+
+def _convert_page_parts(page_path, parser, callback, ignore_errors, ignore_images,
+                        ignore_css, ignore_js, max_workers, resource_cache,
+                        record_urls) -> List[str]:
+    """Convert a page like convert_page, returning the new HTML in parts.
+
+    Joining the parts gives convert_page's result. They can also be written
+    out one at a time, without building the whole page as a single string.
+    See convert_page for the parameters.
+    """
     # Check features
-    if requests_get is None:
+    if SESSION is None:
         callback('INFO', 'feature', "Requests not available, web downloading disabled")
+    if pybase64 is None:
+        callback('INFO', 'feature', "pybase64 not available, using slower base64 encoder")
+    else:
+        # Includes which SIMD instructions it picked for this CPU, if any
+        callback('INFO', 'feature', "Using pybase64 " + pybase64.get_version())
 
     # Get page HTML, whether from a server, a local file, or stdin
     if page_path is None:
@@ -178,70 +498,151 @@ def convert_page(page_path: str, parser: str='auto',
     # so the user can try another when one fails
     if parser == 'auto':
         parser = get_available_parsers()[0]
+        if parser != 'lxml':
+            # Other parsers are many times slower on large pages
+            callback('INFO', 'parser', "lxml not available, falling back to " + parser)
     soup = bs4.BeautifulSoup(page_text, parser)
     callback('INFO', 'parser', "Using parser " + parser)
 
-    tags = []
-
-    # Gather all the relevant tags together
-    if not ignore_images:
-        tags += soup('img')
-    if not ignore_css:
-        csstags = soup('link')
-        for css in csstags:
-            if 'stylesheet' in css['rel']:
-                tags.append(css)
-    if not ignore_js:
-        scripttags = soup('script')
-        for script in scripttags:
-            if 'src' in script.attrs:
-                tags.append(script)
+    # Gather all the relevant tags together in a single pass over the tree,
+    # along with the attribute holding their URL. The selector itself filters
+    # out links that aren't stylesheets, inline scripts, and tags without a
+    # URL at all.
+    selectors = [selector for selector, ignored in [('img[src]', ignore_images),
+                                                    ('link[rel~="stylesheet"][href]', ignore_css),
+                                                    ('script[src]', ignore_js)]
+                 if not ignored]
+    jobs = []
+    for tag in soup.select(', '.join(selectors)) if selectors else []:
+        if tag.name == 'link':
+            # Alternate, disabled and titled (preferred) stylesheets would
+            # always apply if inlined
+            attr = 'href'
+            inline_tag = None if ('alternate' in tag['rel'] or tag.has_attr('disabled')
+                                  or tag.has_attr('title')) else 'style'
+        elif tag.name == 'script':
+            # Inline scripts can't be deferred, they run as soon as they're parsed
+            attr = 'src'
+            inline_tag = None if tag.has_attr('async') or tag.has_attr('defer') else 'script'
+        else:
+            attr, inline_tag = 'src', None
+        tag_url = tag[attr].strip(URL_STRIP_CHARS)
+        # Resources that are already data URIs don't need processing, skip
+        # them up front instead of having them rejected by _get_resource
+        if tag_url[:5].lower() == 'data:':
+            callback('INFO', tag.name, "Already data URI")
+        else:
+            jobs.append((tag, attr, tag_url, inline_tag))
+
+    # Download and encode the linked resources in parallel. The tree is only
+    # modified afterwards, on this thread, as BS4 is not thread-safe. The
+    # workers don't report progress either, so the callback (which usually
+    # prints) is never run concurrently or holds up the downloads.
+    # BUG: doesn't work if using relative remote URLs in a local file
+    # Resources are identified by their full path and the tag they are inlined
+    # in (if any), as that changes how they are loaded
+    resource_keys = [(_urljoin(page_path, tag_url), inline_tag) for _, _, tag_url, inline_tag in jobs]
+    # Pages often link the same resource several times, only load each once
+    if resource_cache is None:
+        resource_cache = {}
+    unique_keys = [key for key in set(resource_keys) if key not in resource_cache]
+    results = {}
+    if unique_keys:
+        # Don't start more threads than there are resources to load
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_keys))) as executor:
+            results = dict(zip(unique_keys, executor.map(lambda key: _load_resource(*key), unique_keys)))
+    # Only successfully loaded resources are cached, errors are reported again
+    # if another page links the resource
+    for key, (text, encoded_resource, error) in results.items():
+        if error is None:
+            resource_cache[key] = text, encoded_resource
+
+    # Data URIs can be megabytes long. Instead of storing them in the tree,
+    # where BS4 would scan all of them for characters to escape during
+    # serialization, the tags get a short unique placeholder which is swapped
+    # for the real data URI (or inlined text) in the serialized HTML.
+    placeholder = f"htmlark-{uuid.uuid4().hex}-"
+    encoded_resources = []
+    manifest = []
 
     # Convert the linked resources
-    for tag in tags:
-        tag_url = tag['href'] if tag.name == 'link' else tag['src']
-        try:
-            # BUG: doesn't work if using relative remote URLs in a local file
-            fullpath = urljoin(page_path, tag_url)
-            tag_mime, tag_data = _get_resource(fullpath)
-        except RequestException:
+    for (tag, attr, tag_url, _), key in zip(jobs, resource_keys):
+        manifest.append(f"{tag.name}:{tag_url}")
+        fullpath = key[0]
+        if key in resource_cache:
+            (text, encoded_resource), error = resource_cache[key], None
+        else:
+            text, encoded_resource, error = results[key]
+        if isinstance(error, RequestException):
             callback('ERROR', tag.name, "Can't access URL " + fullpath)
             if not ignore_errors:
-                raise
-        except OSError as e:
-            callback('ERROR', tag.name, "Error reading '{}': {}".format(e.filename, e.strerror))
+                raise error
+        elif isinstance(error, OSError):
+            callback('ERROR', tag.name, f"Error reading '{error.filename}': {error.strerror}")
             if not ignore_errors:
-                raise
-        except ValueError as e:
-            # Raised when a problem with the URL is found
-            scheme = e.args[1]
-            # Don't need to process things that are already data URIs
-            if scheme == 'data':
-                callback('INFO', tag.name, "Already data URI")
-            else:
-                # htmlark can only get from http/https and local files
-                callback('ERROR', tag.name, "Unknown protocol in URL: " + tag_url)
-                if not ignore_errors:
-                    raise
-        except NameError as e:
+                raise error
+        elif isinstance(error, ValueError):
+            # Raised when a problem with the URL is found. htmlark can only
+            # get from http/https and local files.
+            callback('ERROR', tag.name, "Unknown protocol in URL: " + tag_url)
+            if not ignore_errors:
+                raise error
+        elif isinstance(error, NameError):
             # Requests module is not available
-            callback('ERROR', tag.name, str(e))
+            callback('ERROR', tag.name, str(error))
             if not ignore_errors:
-                raise
-        else:
-            encoded_resource = make_data_uri(tag_mime, tag_data)
+                raise error
+        elif text is not None:
+            callback('INFO', tag.name, tag_url)
             if tag.name == 'link':
-                tag['href'] = encoded_resource
+                # Keep the attributes that still apply to a <style>, e.g.
+                # media, id and nonce
+                style = soup.new_tag('style', attrs={name: value for name, value in tag.attrs.items()
+                                                     if name not in ('rel', 'href', 'type')})
+                tag.replace_with(style)
+                tag = style
             else:
-                tag['src'] = encoded_resource
+                del tag['src']
+            tag.string = placeholder + str(len(encoded_resources))
+            encoded_resources.append(text)
+        else:
             callback('INFO', tag.name, tag_url)
-        # Record the original URL so the original HTML can be recovered
-        tag.insert_after(bs4.Comment("URL:" + tag_url))
-
+            tag[attr] = placeholder + str(len(encoded_resources))
+            encoded_resources.append(encoded_resource)
+
+    # Record the original URLs so the original HTML can be recovered. They
+    # are all listed in one comment, as inserting a comment after each tag
+    # means modifying the tree for every resource.
+    if record_urls and manifest:
+        (soup.body or soup).append(bs4.Comment("htmlark-manifest\n" + "\n".join(manifest) + "\n"))
     soup.html.insert_after(bs4.Comment(
-        "Generated by HTMLArk {}. Original URL {}".format(datetime.now(),
-                                                          page_path)))
-    return str(soup)
+        f"Generated by HTMLArk {datetime.now()}. Original URL {page_path}"))
+    # Splitting on the placeholders leaves the resource numbers at the odd
+    # indices, swap those for the resources and join everything in one go
+    output_parts = re.split(re.escape(placeholder) + r'(\d+)', str(soup))
+    output_parts[1::2] = [encoded_resources[int(i)] for i in output_parts[1::2]]
+    return output_parts
+
+
+def _output_file(path: str):
+    """Open the output file for argparse, in binary mode.
+
+    argparse.FileType('wb') returns the text-mode ``sys.stdout`` for ``-`` on
+    Python versions before 3.9, which can't be written bytes.
+
+    Parameters:
+        path (str): Path of the file to write, or ``-`` for stdout.
+    Returns:
+        A binary file object.
+    Raises:
+        argparse.ArgumentTypeError: The file could not be opened.
+    """
+    if path == '-':
+        return sys.stdout.buffer
+    try:
+        return open(path, 'wb', buffering=OUTPUT_BUFFER_SIZE)
+    except OSError as e:
+        raise argparse.ArgumentTypeError(f"can't open '{path}': {e}")
 
 
 def _get_options():
@@ -255,8 +656,8 @@ def _get_options():
     parser.add_argument('webpage', nargs='?', default=None,
                         help="""URL or path of webpage to convert. If not
                         specified, read from STDIN.""")
-    parser.add_argument('-o', '--output', default=sys.stdout,
-                        type=argparse.FileType('w', encoding='UTF-8'),
+    # Output is written as binary, the HTML is encoded to UTF-8 as it's written
+    parser.add_argument('-o', '--output', default=sys.stdout.buffer, type=_output_file,
                         help="File to write output. Defaults to STDOUT.")
     parser.add_argument('-E', '--ignore-errors', action='store_true', default=False,
                         help="Ignores unreadable resources")
@@ -266,6 +667,21 @@ def _get_options():
                         help="Ignores stylesheets during conversion")
     parser.add_argument('-J', '--ignore-js', action='store_true', default=False,
                         help="Ignores external JavaScript during conversion")
+    parser.add_argument('-j', '--jobs', type=int, default=MAX_WORKERS,
+                        help=f"""Maximum number of resources to download
+                                simultaneously. Defaults to {MAX_WORKERS}.""")
+    parser.add_argument('--cache', action='store_true', default=False,
+                        help="""Caches downloads in ~/.cache/htmlark, so
+                                unchanged resources are not downloaded again.
+                                Requires requests-cache.""")
+    parser.add_argument('--cache-expiry', type=int, default=HTTP_CACHE_EXPIRY,
+                        metavar='SECONDS',
+                        help=f"""Seconds before cached downloads that the
+                                server can't revalidate expire, with --cache.
+                                Defaults to {HTTP_CACHE_EXPIRY}.""")
+    parser.add_argument('-R', '--record-urls', action='store_true', default=False,
+                        help="""Lists the original URLs of embedded resources
+                                in a comment at the end of the page""")
     parser.add_argument('-p', '--parser', default='auto',
                         choices=['html.parser', 'lxml', 'html5lib', 'auto'],
                         help="""Select HTML parser. Defaults to auto, which
@@ -277,7 +693,7 @@ def _get_options():
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help="Prints information during conversion")
     parser.add_argument('-V', '--version', action='version',
-                        version="HTMLArk v{}".format(__version__),
+                        version=f"HTMLArk v{__version__}",
                         help="Displays version information")
     parsed = parser.parse_args()
 
@@ -316,41 +732,53 @@ def _main():
         # Only display info messages if -v/--verbose flag is set
         if severity == 'INFO':
             if options.verbose:
-                print_verbose("{}: {}".format(tagtype, message_data))
+                print_verbose(f"{tagtype}: {message_data}")
         elif severity == 'ERROR':
-            print_error("{}: {}".format(tagtype, message_data))
+            print_error(f"{tagtype}: {message_data}")
         else:
-            print_error("Unknown message level {}, please tell the author of the program".format(severity))
-            print_error("{}: {}".format(tagtype, message_data))
+            print_error(f"Unknown message level {severity}, please tell the author of the program")
+            print_error(f"{tagtype}: {message_data}")
+
+    if options.cache:
+        try:
+            enable_http_cache(expire_after=options.cache_expiry)
+        except NameError:
+            sys.exit("Cannot cache downloads: Need requests-cache installed")
+        print_verbose(f"Caching downloads in {HTTP_CACHE_PATH}")
 
     # Convert page
     if options.webpage is None:
         print_verbose("Reading from STDIN")
     else:
-        print_verbose("Processing {}".format(options.webpage))
+        print_verbose(f"Processing {options.webpage}")
 
     try:
-        newhtml = convert_page(options.webpage,
-                               parser=options.parser,
-                               ignore_errors=options.ignore_errors,
-                               ignore_images=options.ignore_images,
-                               ignore_css=options.ignore_css,
-                               ignore_js=options.ignore_js,
-                               callback=info_callback)
+        # Get the page in parts, so it can be written out without joining it
+        # into (and then encoding) one huge string first
+        page_parts = _convert_page_parts(options.webpage,
+                                         parser=options.parser,
+                                         callback=info_callback,
+                                         ignore_errors=options.ignore_errors,
+                                         ignore_images=options.ignore_images,
+                                         ignore_css=options.ignore_css,
+                                         ignore_js=options.ignore_js,
+                                         max_workers=options.jobs,
+                                         resource_cache=None,
+                                         record_urls=options.record_urls)
     except (OSError, RequestException, ValueError) as e:
-        sys.exit("Unable to convert webpage: {}".format(e))
+        sys.exit(f"Unable to convert webpage: {e}")
     except NameError:
         raise
         sys.exit("Cannot download web resource: Need Requests installed")
 
     # Write output
     try:
-        options.output.write(newhtml)
+        options.output.writelines(part.encode('utf-8') for part in page_parts)
     except OSError as e:
         # Note that argparse handles errors opening the file handle
-        sys.exit("Unable to write to output file: {}".format(e.strerror))
+        sys.exit(f"Unable to write to output file: {e.strerror}")
 
-    print_verbose("All done, output written to " + options.output.name)
+    print_verbose(f"All done, output written to {options.output.name}")
 
 
 def _main_wrapper():
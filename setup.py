@@ -30,7 +30,7 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.6',
         'Topic :: Software Development :: Libraries',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'Topic :: System :: Archiving',
@@ -38,10 +38,13 @@ setup(
     ],
     keywords="development html webpage css javascript",
     py_modules=['htmlark'],
-    install_requires=['beautifulsoup4'],
+    python_requires='>=3.6',
+    install_requires=['beautifulsoup4>=4.7', 'lxml'],
     extras_require={
-        'parsers': ['lxml', 'html5lib'],
+        'parsers': ['html5lib'],
         'http': ['requests'],
+        'speedups': ['pybase64'],
+        'cache': ['requests-cache>=0.9'],
     },
     entry_points={
         'console_scripts': [
@@ -1,19 +1,195 @@
 """Test cases for HTMLArk."""
 
+import argparse
+import http.server
 import importlib
 import os.path
+import sys
+import tempfile
+import threading
 import unittest
+from unittest import mock
+
+import bs4
 
 import htmlark
 
 # Check for existance of requests
 requests_spec = importlib.util.find_spec('requests')
 requests_available = True if requests_spec else False
+requests_cache_available = importlib.util.find_spec('requests_cache') is not None
+
+
+class ChangingResourceHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a different body on every request, without ETag or Last-Modified."""
+
+    requests_served = 0
+
+    def do_GET(self):  # NOQA
+        """Send the next version of the resource."""
+        ChangingResourceHandler.requests_served += 1
+        body = f"v{self.requests_served}".encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        """Keep the test output clean."""
+        pass
 
 
 class TestHTMLArk(unittest.TestCase):  # NOQA
     """Test HTMLArk module."""
 
+    def test_convert_page(self):
+        """Test that linked resources are embedded as data URIs."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/example.html")
+        soup = bs4.BeautifulSoup(htmlark.convert_page(test_page), 'html.parser')
+
+        self.assertTrue(soup.img['src'].startswith("data:image/jpeg;base64,"))
+        # Stylesheets and scripts are inlined
+        self.assertIsNone(soup.link)
+        self.assertIsNone(soup.script.get('src'))
+        for tag, filename in [(soup.style, "style.css"), (soup.script, "script.js")]:
+            with open(os.path.join(os.path.dirname(__file__), "testpages", filename)) as f:
+                self.assertEqual(tag.string, f.read())
+
+    def test_convert_page_datauri(self):
+        """Test that existing data URIs are left alone."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/datauri.html")
+        messages = []
+        newhtml = htmlark.convert_page(test_page, callback=lambda *m: messages.append(m))
+        soup = bs4.BeautifulSoup(newhtml, 'html.parser')
+        images = soup('img')
+        self.assertEqual(images[0]['src'], "data:replacethiswhenreversefunctionadded")
+        # Spaces around the URI don't hide that it is one
+        self.assertEqual(images[1]['src'], " data:image/png;base64,iVBORw==")
+        self.assertEqual(messages.count(('INFO', 'img', "Already data URI")), 2)
+
+    def test_convert_page_duplicates(self):
+        """Test that resources linked more than once are only loaded once."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/duplicates.html")
+        with mock.patch('htmlark._load_resource', wraps=htmlark._load_resource) as load_resource:
+            newhtml = htmlark.convert_page(test_page)
+        self.assertEqual(load_resource.call_count, 2)
+
+        soup = bs4.BeautifulSoup(newhtml, 'html.parser')
+        image_uris = [img['src'] for img in soup('img')]
+        self.assertEqual(len(image_uris), 3)
+        self.assertEqual(len(set(image_uris)), 1)
+        self.assertTrue(image_uris[0].startswith("data:image/jpeg;base64,"))
+
+    @unittest.skipUnless(requests_available, "Requests library not installed")
+    def test_convert_page_content_type_params(self):
+        """Test that quotes in a server's Content-Type don't break the page."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/remote.html")
+        for content_type in ['image/png; name="a b"', 'image/png; name="a,b"']:
+            response = mock.MagicMock(headers={'Content-Type': content_type})
+            response.iter_content.return_value = [b"\x89PNG"]
+            with mock.patch.object(htmlark.SESSION, 'get', return_value=response):
+                newhtml = htmlark.convert_page(test_page)
+            soup = bs4.BeautifulSoup(newhtml, 'html.parser')
+            self.assertEqual(soup.img['src'], f"data:{content_type};base64,iVBORw==")
+            self.assertIsNotNone(soup.find('p'))
+
+    def test_convert_page_record_urls(self):
+        """Test that the original URLs are listed only when requested."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/example.html")
+        self.assertNotIn("htmlark-manifest", htmlark.convert_page(test_page))
+        soup = bs4.BeautifulSoup(htmlark.convert_page(test_page, record_urls=True), 'html.parser')
+        manifest = soup.body.find_all(string=lambda s: isinstance(s, bs4.Comment))[-1]
+        self.assertEqual(manifest.splitlines(),
+                         ["htmlark-manifest", "link:style.css", "script:script.js", "img:sunset.jpg"])
+
+    def test_convert_page_not_utf8(self):
+        """Test that text that isn't UTF-8 is embedded without losing any bytes."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/latin1.html")
+        soup = bs4.BeautifulSoup(htmlark.convert_page(test_page), 'html.parser')
+        self.assertIsNone(soup.style)
+        with open(os.path.join(os.path.dirname(__file__), "testpages/latin1.css"), 'rb') as f:
+            self.assertEqual(soup.link['href'], htmlark.make_data_uri('text/css', f.read()))
+
+    def test_convert_page_links(self):
+        """Test that only stylesheet <link> tags with a URL are converted."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/links.html")
+        soup = bs4.BeautifulSoup(htmlark.convert_page(test_page), 'html.parser')
+        links = soup('link')
+        self.assertEqual(len(links), 3)
+        self.assertEqual(links[0]['href'], "sunset.jpg")
+        self.assertEqual(links[1]['href'], "style.css")
+        self.assertNotIn('href', links[2].attrs)
+        self.assertIsNotNone(soup.style)
+        self.assertNotIn('src', soup.img.attrs)
+
+    def test_convert_page_stylesheets(self):
+        """Test that inlined stylesheets keep their attributes, and those that can't be are not."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/stylesheets.html")
+        soup = bs4.BeautifulSoup(htmlark.convert_page(test_page), 'html.parser')
+        styles = soup('style')
+        self.assertEqual(len(styles), 2)
+        self.assertEqual(styles[0].attrs, {'id': "theme", 'nonce': "abc", 'media': "print"})
+        # The byte order mark is not inlined
+        self.assertEqual(styles[1].string, "p { color: red; }\n")
+        # Titled and disabled stylesheets become data URIs instead
+        links = soup('link')
+        self.assertEqual([link.get('title') for link in links], ["Default", None])
+        self.assertTrue(links[1].has_attr('disabled'))
+        for link in links:
+            self.assertTrue(link['href'].startswith("data:text/css"))
+
+    def test_convert_page_cache(self):
+        """Test that a resource cache can be shared between conversions."""
+        cache = {}
+        example_page = os.path.join(os.path.dirname(__file__), "testpages/example.html")
+        duplicates_page = os.path.join(os.path.dirname(__file__), "testpages/duplicates.html")
+        htmlark.convert_page(example_page, resource_cache=cache)
+        self.assertEqual(len(cache), 3)
+
+        with mock.patch('htmlark._load_resource') as load_resource:
+            htmlark.convert_page(duplicates_page, resource_cache=cache)
+        load_resource.assert_not_called()
+
+    def test_convert_page_errors(self):
+        """Test that broken links are skipped or raised as requested."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/missing.html")
+        with self.assertRaises(OSError):
+            htmlark.convert_page(test_page)
+
+        errors = []
+        newhtml = htmlark.convert_page(test_page, ignore_errors=True,
+                                       callback=lambda t, c, m: errors.append(c) if t == 'ERROR' else None)
+        soup = bs4.BeautifulSoup(newhtml, 'html.parser')
+        self.assertEqual(soup.img['src'], "imagedoesnotexist")
+        self.assertEqual(sorted(errors), ['img', 'link', 'script'])
+
+    def test_convert_page_read_errors(self):
+        """Test that errors reading streamed files are handled like other errors."""
+        test_page = os.path.join(os.path.dirname(__file__), "testpages/example.html")
+        errors = []
+
+        def mmap_error(*_, **__):
+            raise OSError(19, "No such device")
+        with mock.patch('htmlark.MMAP_THRESHOLD', 1), mock.patch('mmap.mmap', side_effect=mmap_error):
+            with self.assertRaises(OSError):
+                htmlark.convert_page(test_page)
+            newhtml = htmlark.convert_page(test_page, ignore_errors=True,
+                                           callback=lambda t, c, m: errors.append(m) if t == 'ERROR' else None)
+        soup = bs4.BeautifulSoup(newhtml, 'html.parser')
+        self.assertEqual(soup.img['src'], "sunset.jpg")
+        self.assertEqual(len(errors), 3)
+        self.assertIn("sunset.jpg': No such device", "\n".join(errors))
+
+    def test_guess_mimetype(self):
+        """Test guessing MIME types from file extensions."""
+        self.assertEqual(htmlark._guess_mimetype("images/photo.JPG"), "image/jpeg")
+        self.assertEqual(htmlark._guess_mimetype("/style.css"), "text/css")
+        self.assertIsNone(htmlark._guess_mimetype("/img"))
+        # Not in the fast lookup table, left to the mimetypes module
+        self.assertEqual(htmlark._guess_mimetype("test.txt"), "text/plain")
+        self.assertIsNone(htmlark._guess_mimetype("dir.v2/noextension"))
+
     def test_make_data_uri(self):
         """Test functionality of data URI creation."""
         samplestring = b"TEST DATA"
@@ -27,11 +203,78 @@ class TestHTMLArk(unittest.TestCase):  # NOQA
                          "data:text/css," + sample_quoted)
         self.assertEqual(htmlark.make_data_uri('application/javascript', samplestring),
                          "data:application/javascript," + sample_quoted)
+        self.assertEqual(htmlark.make_data_uri('text/plain', samplestring),
+                         "data:text/plain," + sample_quoted)
+        self.assertEqual(htmlark.make_data_uri('image/svg+xml', b'<svg xmlns="http://www.w3.org/2000/svg"/>'),
+                         "data:image/svg+xml,%3Csvg%20xmlns=%22http://www.w3.org/2000/svg%22/%3E")
+        self.assertEqual(htmlark.make_data_uri('Application/JavaScript; charset=utf-8', samplestring),
+                         "data:Application/JavaScript; charset=utf-8," + sample_quoted)
+        # Bytes are quoted as they are, whatever the encoding
+        self.assertEqual(htmlark.make_data_uri('text/plain', b"caf\xe9-au-lait"),
+                         "data:text/plain,caf%E9-au-lait")
+        # Text that would be longer quoted than base64 encoded uses base64
+        self.assertEqual(htmlark.make_data_uri('text/css', b"{  }"),
+                         "data:text/css;base64,eyAgfQ==")
         self.assertEqual(htmlark.make_data_uri('image/jpeg', samplestring),
                          "data:image/jpeg;base64," + sample_base64)
         self.assertEqual(htmlark.make_data_uri('unknown/mime', samplestring),
                          "data:unknown/mime;base64," + sample_base64)
 
+    @unittest.skipUnless(requests_available, "Requests library not installed")
+    def test_enable_http_cache(self):
+        """Test that enable_http_cache switches downloads to a cached session."""
+        self.addCleanup(setattr, htmlark, 'SESSION', htmlark.SESSION)
+        with mock.patch.object(htmlark, 'requests_cache', None):
+            with self.assertRaises(NameError):
+                htmlark.enable_http_cache()
+        with mock.patch.object(htmlark, 'requests_cache') as requests_cache:
+            htmlark.enable_http_cache("dummy_cache")
+        requests_cache.CachedSession.assert_called_once_with(
+            "dummy_cache", backend='sqlite', expire_after=htmlark.HTTP_CACHE_EXPIRY,
+            cache_control=True, always_revalidate=True)
+        self.assertIs(htmlark.SESSION, requests_cache.CachedSession.return_value)
+
+    @unittest.skipUnless(requests_cache_available, "requests-cache library not installed")
+    def test_enable_http_cache_expiry(self):
+        """Test that cached responses without validators expire."""
+        server = http.server.HTTPServer(('localhost', 0), ChangingResourceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://localhost:{server.server_port}/image.png"
+        self.addCleanup(setattr, htmlark, 'SESSION', htmlark.SESSION)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # Fresh responses are reused, even though they can't be revalidated
+            htmlark.enable_http_cache(os.path.join(cache_dir, "fresh"))
+            first = htmlark._get_resource(url)[1]
+            self.assertEqual(htmlark._get_resource(url)[1], first)
+            htmlark.SESSION.close()
+            # Expired ones are downloaded again, not served from the cache forever
+            htmlark.enable_http_cache(os.path.join(cache_dir, "expired"), expire_after=0)
+            second = htmlark._get_resource(url)[1]
+            self.assertNotEqual(second, first)
+            self.assertNotEqual(htmlark._get_resource(url)[1], second)
+            htmlark.SESSION.close()
+
+    def test_output_file(self):
+        """Test that output files, stdout included, are opened in binary mode."""
+        self.assertIs(htmlark._output_file('-'), sys.stdout.buffer)
+        with tempfile.TemporaryDirectory() as output_dir:
+            with htmlark._output_file(os.path.join(output_dir, "out.html")) as output:
+                output.write(b"TEST DATA")
+            with self.assertRaises(argparse.ArgumentTypeError):
+                htmlark._output_file(os.path.join(output_dir, "missing", "out.html"))
+
+    def test_get_available_parsers(self):
+        """Test that only parsers BS4 can use are available."""
+        self.addCleanup(htmlark.get_available_parsers.cache_clear)
+        htmlark.get_available_parsers.cache_clear()
+        # BS4 doesn't register parsers it fails to load, e.g. a broken lxml
+        with mock.patch('bs4.builder.builder_registry.lookup',
+                        side_effect=lambda name: None if name == 'lxml' else mock.sentinel.builder):
+            self.assertEqual(htmlark.get_available_parsers(), ('html5lib', 'html.parser'))
+
     @unittest.skipUnless(requests_available, "Requests library not installed")
     def test_get_resource(self):
         """Test getting resources."""
@@ -42,12 +285,53 @@ class TestHTMLArk(unittest.TestCase):  # NOQA
 
         self.assertEqual(htmlark._get_resource(test_filename), test_resource)
 
+    @unittest.skipUnless(requests_available, "Requests library not installed")
+    def test_get_resource_http_mimetype(self):
+        """Test that the MIME type is guessed when the server doesn't send one."""
+        response = mock.Mock(headers={}, content=b"TEST DATA")
+        with mock.patch.object(htmlark.SESSION, 'get', return_value=response):
+            self.assertEqual(htmlark._get_resource("http://example.com/image.png"),
+                             ('image/png', b"TEST DATA"))
+            # Only the path says what the resource is, not the query
+            self.assertEqual(htmlark._get_resource("http://example.com/image?f=a.js#b.css"),
+                             (None, b"TEST DATA"))
+
+    @unittest.skipUnless(requests_available, "Requests library not installed")
+    def test_get_resource_padded_url(self):
+        """Test that spaces and control characters around URLs are ignored."""
+        response = mock.Mock(headers={'Content-Type': 'image/png'}, content=b"TEST DATA")
+        with mock.patch.object(htmlark.SESSION, 'get', return_value=response) as get:
+            self.assertEqual(htmlark._get_resource("\x00 http://example.com/image.png\t\n"),
+                             ('image/png', b"TEST DATA"))
+        self.assertEqual(get.call_args[0][0], "http://example.com/image.png")
+
+    def test_get_resource_stream(self):
+        """Test streaming local files, both read and memory-mapped."""
+        test_filename = os.path.join(os.path.dirname(__file__), "testpages/sunset.jpg")
+        with open(test_filename, "rb") as test_file:
+            test_uri = htmlark.make_data_uri('image/jpeg', test_file.read())
+        text_filename = os.path.join(os.path.dirname(__file__), "testpages/style.css")
+        with open(text_filename, "rb") as text_file:
+            text_uri = htmlark.make_data_uri('text/css', text_file.read())
+
+        # The chunk size of memory-mapped files is deliberately not a multiple
+        # of 3, so chunks have to be carried over when encoding
+        for threshold, chunk_size in [(htmlark.MMAP_THRESHOLD, htmlark.CHUNK_SIZE), (1, 1000)]:
+            with mock.patch('htmlark.MMAP_THRESHOLD', threshold), \
+                    mock.patch('htmlark.CHUNK_SIZE', chunk_size):
+                mimetype, chunks = htmlark._get_resource(test_filename, stream=True)
+                self.assertEqual(htmlark.make_data_uri(mimetype, chunks), test_uri)
+                # Text is joined before it is encoded
+                mimetype, chunks = htmlark._get_resource(text_filename, stream=True)
+                self.assertEqual(htmlark.make_data_uri(mimetype, chunks), text_uri)
+
     def test_get_resource_errors(self):
         """Test that _get_resource raises the correct errors."""
         with self.assertRaises(ValueError):
             htmlark._get_resource("ftp://example.com/not/a/real/path.png")
             htmlark._get_resource("data:text/plain,somedummydata")
         # Simulate the effects of the 'requests' module not existing
-        htmlark.requests_get = None
+        self.addCleanup(setattr, htmlark, 'SESSION', htmlark.SESSION)
+        htmlark.SESSION = None
         with self.assertRaises(NameError):
             htmlark._get_resource("http://example.com/not/a/real/path.png")